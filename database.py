@@ -1,80 +1,354 @@
-import sqlite3
+import asyncio
+import atexit
+import collections
 import logging
-from typing import List, Optional, Tuple
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Deque, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
+
+
+DB_PATH = 'movie_bot.db'
+SCHEMA_VERSION = 3
+READER_POOL_SIZE = 4
+FLUSH_INTERVAL = 0.05
+FAVORITES_CACHE_SIZE = 1024
+_LEGACY_FALLBACK_TITLE = "Неизвестный фильм"
+
+_SQL_INSERT_MOVIE = (
+    "INSERT INTO movies (media_type, movie_id, title, poster_path) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (media_type, movie_id) DO UPDATE SET title = excluded.title, poster_path = excluded.poster_path"
+)
+_SQL_INSERT = (
+    "INSERT INTO favorites (user_id, media_type, movie_id) VALUES (?, ?, ?) "
+    "ON CONFLICT (user_id, media_type, movie_id) DO NOTHING"
+)
+_SQL_DELETE = "DELETE FROM favorites WHERE user_id = ? AND media_type = ? AND movie_id = ?"
+_SQL_SELECT = (
+    "SELECT media_type, movie_id, title, poster_path FROM favorites JOIN movies USING (media_type, movie_id) "
+    "WHERE user_id = ? ORDER BY media_type, movie_id"
+)
+_SQL_SELECT_PAGE = (
+    "SELECT media_type, movie_id, title, poster_path FROM favorites JOIN movies USING (media_type, movie_id) "
+    "WHERE user_id = ? AND (media_type, movie_id) > (?, ?) ORDER BY media_type, movie_id LIMIT ?"
+)
+
+
+def _apply_pragmas(conn: sqlite3.Connection):
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
 
 
 def get_db_connection():
     try:
-        conn = sqlite3.connect('movie_bot.db')
-        conn.row_factory = sqlite3.Row
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                               cached_statements=256, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        _apply_pragmas(conn)
         return conn
-    except Exception as e:
-        logging.error(f"Error connecting to database: {e}")
+    except sqlite3.Error as e:
+        logging.error("Error connecting to database: %s", e)
         raise
 
 
-def init_db():
-    conn = get_db_connection()
+def _get_ro_connection():
     try:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS favorites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                movie_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                poster_path TEXT
-            )
-        ''')
-        conn.commit()
-    finally:
-        conn.close()
+        conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False,
+                               cached_statements=256, isolation_level=None)
+        _apply_pragmas(conn)
+        return conn
+    except sqlite3.Error as e:
+        logging.error("Error opening read-only database connection: %s", e)
+        raise
+
+
+_writer_conn: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
+_reader_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=READER_POOL_SIZE)
 
 
-def add_favorite(user_id: int, movie_id: int, title: str, poster_path: str) -> bool:
+_write_queue: Deque[Tuple[Tuple[Tuple[str, List[Tuple]], ...], Future]] = collections.deque()
+_write_pending = threading.Event()
+
+
+def _flush_writes():
+    batch = []
+    while _write_queue:
+        batch.append(_write_queue.popleft())
+    if not batch:
+        return
+    results = []
     try:
-        conn = get_db_connection()
-        conn.execute(
-            "INSERT INTO favorites (user_id, movie_id, title, poster_path) VALUES (?, ?, ?, ?)",
-            (user_id, movie_id, title, poster_path)
-        )
-        conn.commit()
-        return True
+        with _writer_lock, _writer_conn:
+            _writer_conn.execute("BEGIN IMMEDIATE")
+            for statements, future in batch:
+                _writer_conn.execute("SAVEPOINT write_entry")
+                try:
+                    for sql, rows in statements:
+                        count = _writer_conn.executemany(sql, rows).rowcount
+                except Exception as e:
+                    _writer_conn.execute("ROLLBACK TO write_entry")
+                    results.append((future, None, e))
+                else:
+                    results.append((future, count, None))
+                _writer_conn.execute("RELEASE write_entry")
     except Exception as e:
-        logging.error(f"Error adding favorite: {e}")
-        return False
-    finally:
-        conn.close()
+        for _, future in batch:
+            future.set_exception(e)
+        return
+    for future, count, error in results:
+        if error is None:
+            future.set_result(count)
+        else:
+            future.set_exception(error)
 
 
-def remove_favorite(user_id: int, movie_id: int) -> bool:
-    try:
+def _writer_loop():
+    while True:
+        _write_pending.wait(FLUSH_INTERVAL)
+        _write_pending.clear()
+        _flush_writes()
+
+
+def _ensure_initialized():
+    if _writer_conn is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+
+
+def _submit_write(*statements: Tuple[str, List[Tuple]]) -> int:
+    _ensure_initialized()
+    future: Future = Future()
+    _write_queue.append((statements, future))
+    _write_pending.set()
+    return future.result()
+
+
+@atexit.register
+def _close_connections():
+    if _writer_conn is None:
+        return
+    _flush_writes()
+    while not _reader_pool.empty():
+        _reader_pool.get_nowait().close()
+    with _writer_lock:
+        _writer_conn.close()
+
+
+_MOVIES_DDL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        media_type TEXT NOT NULL,
+        movie_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        poster_path TEXT,
+        PRIMARY KEY (media_type, movie_id)
+    ) WITHOUT ROWID
+'''
+
+_FAVORITES_DDL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id INTEGER NOT NULL,
+        media_type TEXT NOT NULL,
+        movie_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, media_type, movie_id)
+    ) WITHOUT ROWID
+'''
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _migrate_schema(conn: sqlite3.Connection):
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        movie_columns = _table_columns(conn, "movies")
+        if movie_columns and "media_type" not in movie_columns:
+            conn.execute(_MOVIES_DDL.format(table="movies_new"))
+            conn.execute(
+                "INSERT INTO movies_new (media_type, movie_id, title, poster_path) "
+                "SELECT 'movie', movie_id, title, poster_path FROM movies"
+            )
+            conn.execute("DROP TABLE movies")
+            conn.execute("ALTER TABLE movies_new RENAME TO movies")
+        conn.execute(_MOVIES_DDL.format(table="movies"))
+
+        columns = _table_columns(conn, "favorites")
+        if "title" in columns:
+            order = ", id" if "id" in columns else ""
+            conn.execute(
+                "INSERT INTO movies (media_type, movie_id, title, poster_path) "
+                "SELECT 'movie', movie_id, COALESCE(title, :fallback), poster_path FROM favorites "
+                f"WHERE true ORDER BY COALESCE(title, :fallback) <> :fallback{order} "
+                "ON CONFLICT (media_type, movie_id) DO UPDATE "
+                "SET title = excluded.title, poster_path = excluded.poster_path",
+                {"fallback": _LEGACY_FALLBACK_TITLE}
+            )
+        if columns and "media_type" not in columns:
+            conn.execute(_FAVORITES_DDL.format(table="favorites_new"))
+            conn.execute(
+                "INSERT OR IGNORE INTO favorites_new (user_id, media_type, movie_id) "
+                "SELECT user_id, 'movie', movie_id FROM favorites"
+            )
+            conn.execute("DROP TABLE favorites")
+            conn.execute("ALTER TABLE favorites_new RENAME TO favorites")
+        conn.execute(_FAVORITES_DDL.format(table="favorites"))
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+def init_db():
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is not None:
+            return
         conn = get_db_connection()
-        conn.execute(
-            "DELETE FROM favorites WHERE user_id = ? AND movie_id = ?",
-            (user_id, movie_id)
-        )
-        conn.commit()
-        return True
-    except Exception as e:
-        logging.error(f"Error removing favorite: {e}")
+        readers = []
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                _migrate_schema(conn)
+            for _ in range(READER_POOL_SIZE):
+                readers.append(_get_ro_connection())
+        except sqlite3.Error:
+            for reader in readers:
+                reader.close()
+            conn.close()
+            raise
+        for reader in readers:
+            _reader_pool.put(reader)
+        _writer_conn = conn
+    threading.Thread(target=_writer_loop, name="favorites-writer", daemon=True).start()
+
+
+_fav_cache: "collections.OrderedDict[int, List[Tuple]]" = collections.OrderedDict()
+_fav_cache_lock = threading.Lock()
+_fav_cache_version = 0
+_fav_ids: "collections.OrderedDict[int, Set[Tuple[str, int]]]" = collections.OrderedDict()
+
+
+def _invalidate_favorites(user_id: int, added: Iterable[Tuple[str, int]] = (),
+                          removed: Iterable[Tuple[str, int]] = ()):
+    global _fav_cache_version
+    with _fav_cache_lock:
+        _fav_cache_version += 1
+        _fav_cache.pop(user_id, None)
+        ids = _fav_ids.get(user_id)
+        if ids is not None:
+            ids.update(added)
+            ids.difference_update(removed)
+
+
+def _add_favorites_bulk(user_id: int, items: List[Tuple[str, int, str, str]]) -> int:
+    movies = [(media_type, movie_id, title, poster_path) for media_type, movie_id, title, poster_path in items]
+    favorites = [(user_id, media_type, movie_id) for media_type, movie_id, _, _ in items]
+    try:
+        inserted = _submit_write((_SQL_INSERT_MOVIE, movies), (_SQL_INSERT, favorites))
+    except sqlite3.Error as e:
+        logging.error("Error adding favorites: %s", e)
+        return 0
+    if inserted:
+        _invalidate_favorites(user_id, added=[(media_type, movie_id) for media_type, movie_id, _, _ in items])
+    return inserted
+
+
+def _remove_favorite(user_id: int, media_type: str, movie_id: int) -> bool:
+    try:
+        _submit_write((_SQL_DELETE, [(user_id, media_type, movie_id)]))
+    except sqlite3.Error as e:
+        logging.error("Error removing favorite: %s", e)
         return False
+    _invalidate_favorites(user_id, removed=[(media_type, movie_id)])
+    return True
+
+
+def iter_favorites(user_id: int, *, after: Optional[Tuple[str, int]] = None,
+                   limit: Optional[int] = None) -> Iterator[Tuple]:
+    if after is None and limit is None:
+        sql, params = _SQL_SELECT, (user_id,)
+    else:
+        sql, params = _SQL_SELECT_PAGE, (user_id, *(after or ("", 0)), -1 if limit is None else limit)
+    _ensure_initialized()
+    conn = _reader_pool.get()
+    try:
+        yield from conn.execute(sql, params)
     finally:
-        conn.close()
+        _reader_pool.put(conn)
 
 
-def get_favorites(user_id: int) -> List[Tuple]:
+def _load_favorites(user_id: int, version: int) -> List[Tuple]:
     try:
-        conn = get_db_connection()
-        cursor = conn.execute(
-            "SELECT * FROM favorites WHERE user_id = ?",
-            (user_id,)
-        )
-        return cursor.fetchall()
-    except Exception as e:
-        logging.error(f"Error getting favorites: {e}")
+        favorites = list(iter_favorites(user_id))
+    except sqlite3.Error as e:
+        logging.error("Error getting favorites: %s", e)
         return []
-    finally:
-        conn.close()
+    with _fav_cache_lock:
+        if version == _fav_cache_version:
+            _fav_cache[user_id] = favorites
+            _fav_ids[user_id] = {(media_type, movie_id) for media_type, movie_id, _, _ in favorites}
+            if len(_fav_cache) > FAVORITES_CACHE_SIZE:
+                _fav_cache.popitem(last=False)
+            if len(_fav_ids) > FAVORITES_CACHE_SIZE:
+                _fav_ids.popitem(last=False)
+    return favorites
+
+
+def _load_favorites_page(user_id: int, *, after: Optional[Tuple[str, int]],
+                         limit: Optional[int]) -> List[Tuple]:
+    try:
+        return list(iter_favorites(user_id, after=after, limit=limit))
+    except sqlite3.Error as e:
+        logging.error("Error getting favorites: %s", e)
+        return []
+
+
+async def add_favorites_bulk(user_id: int, items: List[Tuple[str, int, str, str]]) -> int:
+    return await asyncio.to_thread(_add_favorites_bulk, user_id, items)
 
 
-init_db()
+async def add_favorite(user_id: int, media_type: str, movie_id: int, title: str, poster_path: str) -> bool:
+    return await add_favorites_bulk(user_id, [(media_type, movie_id, title, poster_path)]) > 0
+
+
+async def remove_favorite(user_id: int, media_type: str, movie_id: int) -> bool:
+    return await asyncio.to_thread(_remove_favorite, user_id, media_type, movie_id)
+
+
+async def get_favorites(user_id: int, *, after: Optional[Tuple[str, int]] = None,
+                        limit: Optional[int] = None) -> List[Tuple]:
+    if after is not None or limit is not None:
+        return await asyncio.to_thread(_load_favorites_page, user_id, after=after, limit=limit)
+    with _fav_cache_lock:
+        favorites = _fav_cache.get(user_id)
+        if favorites is not None:
+            _fav_cache.move_to_end(user_id)
+            return favorites
+        version = _fav_cache_version
+    return await asyncio.to_thread(_load_favorites, user_id, version)
+
+
+async def is_favorite(user_id: int, media_type: str, movie_id: int) -> bool:
+    with _fav_cache_lock:
+        ids = _fav_ids.get(user_id)
+        if ids is not None:
+            _fav_ids.move_to_end(user_id)
+            return (media_type, movie_id) in ids
+    return any(row[:2] == (media_type, movie_id) for row in await get_favorites(user_id))
+
+
+def maintenance():
+    with _writer_lock:
+        try:
+            _writer_conn.execute(
+                "DELETE FROM movies WHERE (media_type, movie_id) NOT IN (SELECT media_type, movie_id FROM favorites)"
+            )
+            _writer_conn.execute("PRAGMA optimize")
+            _writer_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logging.error("Error running database maintenance: %s", e)
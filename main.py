@@ -1,9 +1,13 @@
 import logging
 import asyncio
 import random
+import re
 import ssl
+import time
 import certifi
-from typing import Optional, Dict, Callable
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple
 
 from aiogram import Dispatcher, types, F
 from aiogram.filters import Command
@@ -11,15 +15,97 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import aiohttp
-from aiohttp import ClientError, ClientConnectorError, ServerTimeoutError, ClientTimeout
+from aiohttp import ClientError, ClientTimeout
 
-from database import add_favorite, remove_favorite, get_favorites
+from database import init_db, maintenance, add_favorite, remove_favorite, get_favorites, is_favorite
 from config import bot, TMDB_API_KEY, TMDB_BASE_URL, TMDB_IMAGE_BASE_URL
 
 logging.basicConfig(level=logging.INFO)
 dp = Dispatcher()
 
-last_messages: Dict[int, int] = {}
+DB_MAINTENANCE_INTERVAL = 24 * 60 * 60
+LAST_MESSAGES_SIZE = 10000
+SEEN_UPDATES_SIZE = 1000
+PHOTO_CACHE_SIZE = 10000
+KEYBOARD_CACHE_SIZE = 4096
+
+API_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 300
+LIST_CACHE_TTL = 300
+DETAILS_CACHE_TTL = 24 * 60 * 60
+POPULAR_REFRESH_INTERVAL = LIST_CACHE_TTL - 60
+TMDB_MAX_CONCURRENCY = 20
+
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+API_TIMEOUT = ClientTimeout(total=30)
+
+POPULAR_MOVIES_URL = f"{TMDB_BASE_URL}/movie/popular"
+POPULAR_TV_URL = f"{TMDB_BASE_URL}/tv/popular"
+POPULAR_PARAMS = {"language": "ru-RU", "page": 1}
+
+last_messages: "OrderedDict[int, int]" = OrderedDict()
+http_session: Optional[aiohttp.ClientSession] = None
+seen_updates: "OrderedDict[int, None]" = OrderedDict()
+photo_file_ids: "OrderedDict[str, str]" = OrderedDict()
+api_cache: "OrderedDict[Tuple, Tuple[float, dict]]" = OrderedDict()
+api_inflight: Dict[Tuple, asyncio.Task] = {}
+popular_refresh_task: Optional[asyncio.Task] = None
+tmdb_semaphore = asyncio.Semaphore(TMDB_MAX_CONCURRENCY)
+
+
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔍 Поиск фильма", callback_data="search")],
+    [InlineKeyboardButton(text="🎲 Случайный контент", callback_data="random")],
+    [InlineKeyboardButton(text="⭐ Избранное", callback_data="favorites")],
+    [InlineKeyboardButton(text="📺 Рекомендации", callback_data="recommendations")]
+])
+
+BACK_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
+])
+
+RANDOM_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🎬 Фильм", callback_data="random_movie")],
+    [InlineKeyboardButton(text="📺 Сериал", callback_data="random_tv")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
+])
+
+RECS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🎬 Популярные фильмы", callback_data="popular_movies")],
+    [InlineKeyboardButton(text="📺 Популярные сериалы", callback_data="popular_tv")],
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
+])
+
+BACK_TO_RANDOM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
+])
+
+ADD_FAVORITE_ACTION = ("⭐ Добавить в избранное", "add_favorite_{media_type}_{item_id}")
+
+LIST_ACTIONS = {
+    "page": (ADD_FAVORITE_ACTION, ("📺 Похожие фильмы", "similar_{item_id}")),
+    "popular": (ADD_FAVORITE_ACTION,),
+    "similar": (ADD_FAVORITE_ACTION,),
+    "favorite": (("❌ Удалить из избранного", "remove_favorite_{media_type}_{item_id}"),),
+}
+
+FAVORITE_CALLBACK_RE = re.compile(r"^(?:add|remove)_favorite_(?:(movie|tv)_)?(\d+)$")
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def list_keyboard(kind: str, media_type: str, item_id: int, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"prev_{kind}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"next_{kind}"))
+    nav_buttons.append(InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main"))
+
+    action_buttons = [
+        [InlineKeyboardButton(text=text, callback_data=callback_data.format(media_type=media_type, item_id=item_id))]
+        for text, callback_data in LIST_ACTIONS[kind]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=action_buttons + [nav_buttons])
 
 
 class MovieStates(StatesGroup):
@@ -32,92 +118,186 @@ class APIError(Exception):
     pass
 
 
-async def delete_last_message(chat_id: int):
-    if chat_id in last_messages:
-        try:
-            await bot.delete_message(chat_id, last_messages[chat_id])
-        except Exception as e:
-            logging.error(f"Error deleting message: {e}")
+async def delete_message(chat_id: int, message_id: int):
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        logging.error(f"Error deleting message: {e}")
 
 
 async def send_message_with_cleanup(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
                                     photo: Optional[str] = None):
-    await delete_last_message(chat_id)
+    previous_id = last_messages.pop(chat_id, None)
+    delete_task = asyncio.create_task(delete_message(chat_id, previous_id)) if previous_id else None
     try:
         if photo:
-            message = await bot.send_photo(chat_id, photo, caption=text, reply_markup=reply_markup)
+            file_id = photo_file_ids.get(photo)
+            if file_id is not None:
+                photo_file_ids.move_to_end(photo)
+            message = await bot.send_photo(chat_id, file_id or photo, caption=text, reply_markup=reply_markup)
+            if file_id is None and message.photo:
+                photo_file_ids[photo] = message.photo[-1].file_id
+                if len(photo_file_ids) > PHOTO_CACHE_SIZE:
+                    photo_file_ids.popitem(last=False)
         else:
             message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
         last_messages[chat_id] = message.message_id
+        if len(last_messages) > LAST_MESSAGES_SIZE:
+            last_messages.popitem(last=False)
         return message
     except Exception as e:
         logging.error(f"Error sending message: {e}")
         raise
+    finally:
+        if delete_task:
+            await delete_task
 
 
-async def make_api_request(url, max_retries=3, retry_delay=1):
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    timeout = ClientTimeout(total=30)
-
+async def make_api_request(session: aiohttp.ClientSession, url, params=None, max_retries=3, retry_delay=1):
+    params = {"api_key": TMDB_API_KEY, **(params or {})}
     for attempt in range(max_retries):
         try:
-            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                try:
-                    async with session.get(url) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:
-                            retry_after = int(response.headers.get('Retry-After', retry_delay))
-                            logging.warning(f"Rate limited. Waiting {retry_after} seconds.")
-                            await asyncio.sleep(retry_after)
-                            continue
-                        else:
-                            raise APIError(f"API request failed with status {response.status}")
-                except (ClientError, ClientConnectorError, ServerTimeoutError) as e:
-                    logging.error(f"API request failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (2 ** attempt)
-                        logging.info(f"Retrying in {wait_time} seconds...")
-                        await asyncio.sleep(wait_time)
-                    continue
-        except Exception as e:
-            logging.error(f"Unexpected error during API request: {str(e)}")
-            if attempt < max_retries - 1:
-                wait_time = retry_delay * (2 ** attempt)
-                logging.info(f"Retrying in {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
-            continue
-    raise APIError("Max retries exceeded")
+            async with tmdb_semaphore:
+                async with session.get(url, params=params) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    elif response.status != 429:
+                        raise APIError(f"API request failed with status {response.status}")
+                    retry_after = int(response.headers.get('Retry-After', retry_delay))
+            logging.warning(f"Rate limited. Waiting {retry_after} seconds.")
+            await asyncio.sleep(retry_after)
+        except (ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"API request failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
+            if attempt == max_retries - 1:
+                raise
+            wait_time = retry_delay * (2 ** attempt)
+            logging.info(f"Retrying in {wait_time} seconds...")
+            await asyncio.sleep(wait_time)
+    raise APIError("Still rate limited after max retries")
+
+
+async def _fetch_and_cache(session: aiohttp.ClientSession, url: str, params: dict, key: Tuple):
+    try:
+        data = await make_api_request(session, url, params)
+        api_cache[key] = (time.monotonic(), data)
+        api_cache.move_to_end(key)
+        if len(api_cache) > API_CACHE_SIZE:
+            api_cache.popitem(last=False)
+        return data
+    finally:
+        api_inflight.pop(key, None)
+
+
+async def cached_get(session: aiohttp.ClientSession, url: str, params: dict, ttl: float):
+    key = (url, tuple(sorted(params.items())))
+    cached = api_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        api_cache.move_to_end(key)
+        return cached[1]
+
+    task = api_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache(session, url, params, key))
+        api_inflight[key] = task
+    return await asyncio.shield(task)
+
+
+def list_source(url: str, params: dict, ttl: float) -> dict:
+    return {"url": url, "params": params, "ttl": ttl}
+
+
+def parse_favorite_callback(data: str) -> Optional[Tuple[str, int]]:
+    match = FAVORITE_CALLBACK_RE.match(data)
+    if match is None:
+        return None
+    return match.group(1) or "movie", int(match.group(2))
+
+
+def favorite_item(row: Tuple) -> dict:
+    media_type, movie_id, title, poster_path = row
+    return {
+        'id': movie_id,
+        'media_type': media_type,
+        'title': title,
+        'poster_path': poster_path,
+        'overview': '',
+        'vote_average': 0,
+        'release_date': ''
+    }
+
+
+async def resolve_item(user_id: int, source: Optional[dict], entry: list) -> Optional[dict]:
+    media_type, item_id = entry
+    if source is None:
+        for row in await get_favorites(user_id):
+            if row[:2] == (media_type, item_id):
+                return favorite_item(row)
+        return None
+
+    data = await cached_get(http_session, source["url"], source["params"], ttl=source["ttl"])
+    for item in data.get("results", []):
+        if item.get("id") == item_id and item.get("media_type", media_type) == media_type:
+            return dict(item, media_type=media_type)
+
+    url = f"{TMDB_BASE_URL}/{media_type}/{item_id}"
+    item = await cached_get(http_session, url, {"language": "ru-RU"}, ttl=DETAILS_CACHE_TTL)
+    return dict(item, media_type=media_type) if isinstance(item, dict) else item
+
+
+async def find_shown_item(user_id: int, data: dict, media_type: str, item_id: int) -> Optional[dict]:
+    for list_name in ("search", "popular", "similar"):
+        for entry in data.get(f"{list_name}_ids", []):
+            if tuple(entry) == (media_type, item_id):
+                return await resolve_item(user_id, data.get(f"{list_name}_source"), entry)
+    return None
+
+
+def release_year(item: dict) -> str:
+    date = item.get("release_date") or item.get("first_air_date") or ""
+    return date[:4] or "Неизвестно"
+
+
+def render_card(item: dict, header: str, icon: str = "🎬") -> str:
+    title = item.get("title") or item.get("name") or "Нет названия"
+    return "\n".join((
+        f"{header}\n",
+        f"{icon} {title}",
+        f"📅 Год: {release_year(item)}",
+        f"⭐ Рейтинг: {item.get('vote_average', 'Нет рейтинга')}/10",
+        f"📝 {item.get('overview') or 'Нет описания'}"
+    ))
+
+
+@dp.update.outer_middleware()
+async def skip_duplicate_updates(handler, event: types.Update, data: dict):
+    if event.update_id in seen_updates:
+        logging.info(f"Skipping duplicate update {event.update_id}")
+        return None
+    seen_updates[event.update_id] = None
+    if len(seen_updates) > SEEN_UPDATES_SIZE:
+        seen_updates.popitem(last=False)
+    return await handler(event, data)
 
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Поиск фильма", callback_data="search")],
-        [InlineKeyboardButton(text="🎲 Случайный контент", callback_data="random")],
-        [InlineKeyboardButton(text="⭐ Избранное", callback_data="favorites")],
-        [InlineKeyboardButton(text="📺 Рекомендации", callback_data="recommendations")]
-    ])
     await send_message_with_cleanup(
         message.chat.id,
         "Привет! Я помогу тебе найти интересные фильмы и сериалы.\nВыбери действие:",
-        reply_markup=keyboard
+        reply_markup=MAIN_MENU_KB
     )
 
 
 @dp.callback_query(F.data == "search")
 async def process_search(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message:
         return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-    ])
     await send_message_with_cleanup(
         callback.message.chat.id,
         "Введите название фильма для поиска:",
-        reply_markup=keyboard
+        reply_markup=BACK_KB
     )
     await state.set_state(MovieStates.waiting_for_search)
 
@@ -127,53 +307,34 @@ async def process_search_query(message: types.Message, state: FSMContext):
     if not message or not message.text:
         return
 
-    async with aiohttp.ClientSession():
-        url = f"{TMDB_BASE_URL}/search/multi?api_key={TMDB_API_KEY}&language=ru-RU&query={message.text}"
-        data = await make_api_request(url)
+    url = f"{TMDB_BASE_URL}/search/multi"
+    params = {"language": "ru-RU", "query": message.text}
+    data = await cached_get(http_session, url, params, ttl=SEARCH_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-            ])
-            await send_message_with_cleanup(
-                message.chat.id,
-                "По вашему запросу ничего не найдено.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            message.chat.id,
+            "По вашему запросу ничего не найдено.",
+            reply_markup=BACK_KB
+        )
+        return
 
-        results = [item for item in data.get("results", []) if item.get("media_type") in ["movie", "tv"]]
-        total_pages = len(results)
+    results = [item for item in data.get("results", []) if item.get("media_type") in ["movie", "tv"]]
+    total_pages = len(results)
 
-        await state.update_data(search_results=results, current_page=0, total_pages=total_pages, content_type="search")
-        await show_search_results(message.chat.id, results[0], 0, total_pages)
+    await state.update_data(search_ids=[[item["media_type"], item["id"]] for item in results],
+                            search_source=list_source(url, params, SEARCH_CACHE_TTL),
+                            current_page=0, total_pages=total_pages, content_type="search")
+    await show_search_results(message.chat.id, results[0], "search", 0, total_pages)
 
 
-async def show_search_results(chat_id: int, item: dict, current_page: int, total_pages: int):
+async def show_search_results(chat_id: int, item: dict, content_type: str, current_page: int, total_pages: int):
     if not isinstance(item, dict) or not item.get("id"):
         return
 
-    text = (
-        f"🔍 Результат поиска ({current_page + 1} из {total_pages}):\n\n"
-        f"🎬 {item.get('title', item.get('name', 'Нет названия'))}\n"
-        f"📅 Год: {item.get('release_date', item.get('first_air_date', 'Неизвестно'))[:4]}\n"
-        f"⭐ Рейтинг: {item.get('vote_average', 'Нет рейтинга')}/10\n"
-        f"📝 {item.get('overview', 'Нет описания')}\n"
-    )
+    text = render_card(item, f"🔍 Результат поиска ({current_page + 1} из {total_pages}):")
 
-    nav_buttons = []
-    if current_page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data="prev_page"))
-    if current_page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="next_page"))
-    nav_buttons.append(InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main"))
-
-    action_buttons = [
-        [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_{item.get('id')}")],
-        [InlineKeyboardButton(text="📺 Похожие фильмы", callback_data=f"similar_{item.get('id')}")]
-    ]
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=action_buttons + [nav_buttons])
+    keyboard = list_keyboard("page", item["media_type"], item["id"], current_page > 0, current_page < total_pages - 1)
 
     if item.get("poster_path"):
         await send_message_with_cleanup(
@@ -188,131 +349,101 @@ async def show_search_results(chat_id: int, item: dict, current_page: int, total
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message:
         return
 
     await state.clear()
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Поиск фильма", callback_data="search")],
-        [InlineKeyboardButton(text="🎲 Случайный контент", callback_data="random")],
-        [InlineKeyboardButton(text="⭐ Избранное", callback_data="favorites")],
-        [InlineKeyboardButton(text="📺 Рекомендации", callback_data="recommendations")]
-    ])
     await send_message_with_cleanup(
         callback.message.chat.id,
         "Выбери действие:",
-        reply_markup=keyboard
+        reply_markup=MAIN_MENU_KB
     )
 
 
 @dp.callback_query(F.data == "random")
 async def process_random(callback: types.CallbackQuery):
+    await callback.answer()
     if not callback.message:
         return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎬 Фильм", callback_data="random_movie")],
-        [InlineKeyboardButton(text="📺 Сериал", callback_data="random_tv")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-    ])
     await send_message_with_cleanup(
         callback.message.chat.id,
         "Выберите тип контента:",
-        reply_markup=keyboard
+        reply_markup=RANDOM_MENU_KB
     )
 
 
 @dp.callback_query(F.data == "recommendations")
 async def show_recommendations_menu(callback: types.CallbackQuery):
+    await callback.answer()
     if not callback.message:
         return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎬 Популярные фильмы", callback_data="popular_movies")],
-        [InlineKeyboardButton(text="📺 Популярные сериалы", callback_data="popular_tv")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-    ])
     await send_message_with_cleanup(
         callback.message.chat.id,
         "Выберите категорию рекомендаций:",
-        reply_markup=keyboard
+        reply_markup=RECS_MENU_KB
     )
 
 
 @dp.callback_query(F.data == "popular_movies")
 async def show_popular_movies(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message:
         return
 
-    async with aiohttp.ClientSession():
-        url = f"{TMDB_BASE_URL}/movie/popular?api_key={TMDB_API_KEY}&language=ru-RU&page=1"
-        data = await make_api_request(url)
+    url = POPULAR_MOVIES_URL
+    params = POPULAR_PARAMS
+    data = await cached_get(http_session, url, params, ttl=LIST_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-            ])
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                "Не удалось получить популярные фильмы. Попробуйте позже.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            "Не удалось получить популярные фильмы. Попробуйте позже.",
+            reply_markup=BACK_KB
+        )
+        return
 
-        results = data.get("results", [])[:10]
-        await state.update_data(popular_results=results, current_page=0, total_pages=len(results), content_type="movie")
-        await show_popular_content(callback.message.chat.id, results[0], "movie", 0, len(results))
+    results = data.get("results", [])[:10]
+    await state.update_data(popular_ids=[["movie", item["id"]] for item in results],
+                            popular_source=list_source(url, params, LIST_CACHE_TTL),
+                            current_page=0, total_pages=len(results), content_type="movie")
+    await show_popular_content(callback.message.chat.id, results[0], "movie", 0, len(results))
 
 
 @dp.callback_query(F.data == "popular_tv")
 async def show_popular_tv(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message:
         return
 
-    async with aiohttp.ClientSession():
-        url = f"{TMDB_BASE_URL}/tv/popular?api_key={TMDB_API_KEY}&language=ru-RU&page=1"
-        data = await make_api_request(url)
+    url = POPULAR_TV_URL
+    params = POPULAR_PARAMS
+    data = await cached_get(http_session, url, params, ttl=LIST_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-            ])
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                "Не удалось получить популярные сериалы. Попробуйте позже.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            "Не удалось получить популярные сериалы. Попробуйте позже.",
+            reply_markup=BACK_KB
+        )
+        return
 
-        results = data.get("results", [])[:10]
-        await state.update_data(popular_results=results, current_page=0, total_pages=len(results), content_type="tv")
-        await show_popular_content(callback.message.chat.id, results[0], "tv", 0, len(results))
+    results = data.get("results", [])[:10]
+    await state.update_data(popular_ids=[["tv", item["id"]] for item in results],
+                            popular_source=list_source(url, params, LIST_CACHE_TTL),
+                            current_page=0, total_pages=len(results), content_type="tv")
+    await show_popular_content(callback.message.chat.id, results[0], "tv", 0, len(results))
 
 
 async def show_popular_content(chat_id: int, item: dict, content_type: str, current_page: int, total_pages: int):
     if not isinstance(item, dict) or not item.get("id"):
         return
 
-    text = (
-        f"📺 Топ {content_type} ({current_page + 1} из {total_pages}):\n\n"
-        f"🎬 {item.get('title', item.get('name', 'Нет названия'))}\n"
-        f"📅 Год: {item.get('release_date', item.get('first_air_date', 'Неизвестно'))[:4]}\n"
-        f"⭐ Рейтинг: {item.get('vote_average', 'Нет рейтинга')}/10\n"
-        f"📝 {item.get('overview', 'Нет описания')}\n"
-    )
-
-    nav_buttons = []
-    if current_page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data="prev_popular"))
-    if current_page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="next_popular"))
-    nav_buttons.append(InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main"))
-
-    action_buttons = [
-        [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_{item.get('id')}")]
-    ]
+    text = render_card(item, f"📺 Топ {content_type} ({current_page + 1} из {total_pages}):")
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=action_buttons + [nav_buttons])
+    keyboard = list_keyboard("popular", item.get("media_type", content_type), item["id"], current_page > 0, current_page < total_pages - 1)
 
     if item.get("poster_path"):
         await send_message_with_cleanup(
@@ -327,61 +458,32 @@ async def show_popular_content(chat_id: int, item: dict, content_type: str, curr
 
 @dp.callback_query(F.data == "favorites")
 async def show_favorites(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message:
         return
 
-    favorites = get_favorites(callback.from_user.id)
+    favorites = await get_favorites(callback.from_user.id)
 
     if not favorites:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-        ])
         await send_message_with_cleanup(
             callback.message.chat.id,
             "У вас пока нет избранных фильмов.",
-            reply_markup=keyboard
+            reply_markup=BACK_KB
         )
         return
 
-    favorites_dicts = []
-    for fav in favorites:
-        favorites_dicts.append({
-            'id': fav[2],
-            'title': fav[3],
-            'poster_path': fav[4],
-            'overview': '',
-            'vote_average': 0,
-            'release_date': ''
-        })
+    await state.update_data(favorite_ids=[[fav[0], fav[1]] for fav in favorites],
+                            current_page=0, total_pages=len(favorites))
+    await show_favorites_page(callback.message.chat.id, favorite_item(favorites[0]), "movie", 0, len(favorites))
 
-    await state.update_data(favorites=favorites_dicts, current_page=0, total_pages=len(favorites_dicts))
-    await show_favorites_page(callback.message.chat.id, favorites_dicts[0], 0, len(favorites_dicts))
 
-
-async def show_favorites_page(chat_id: int, item: dict, current_page: int, total_pages: int):
+async def show_favorites_page(chat_id: int, item: dict, content_type: str, current_page: int, total_pages: int):
     if not isinstance(item, dict) or not item.get("id"):
         return
 
-    text = (
-        f"⭐ Избранное ({current_page + 1} из {total_pages}):\n\n"
-        f"🎬 {item.get('title', item.get('name', 'Нет названия'))}\n"
-        f"📅 Год: {item.get('release_date', item.get('first_air_date', 'Неизвестно'))[:4]}\n"
-        f"⭐ Рейтинг: {item.get('vote_average', 'Нет рейтинга')}/10\n"
-        f"📝 {item.get('overview', 'Нет описания')}\n"
-    )
+    text = render_card(item, f"⭐ Избранное ({current_page + 1} из {total_pages}):")
 
-    nav_buttons = []
-    if current_page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data="prev_favorite"))
-    if current_page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="next_favorite"))
-    nav_buttons.append(InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main"))
-
-    action_buttons = [
-        [InlineKeyboardButton(text="❌ Удалить из избранного", callback_data=f"remove_favorite_{item.get('id')}")]
-    ]
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=action_buttons + [nav_buttons])
+    keyboard = list_keyboard("favorite", item["media_type"], item["id"], current_page > 0, current_page < total_pages - 1)
 
     if item.get("poster_path"):
         await send_message_with_cleanup(
@@ -394,220 +496,133 @@ async def show_favorites_page(chat_id: int, item: dict, current_page: int, total
         await send_message_with_cleanup(chat_id, text, reply_markup=keyboard)
 
 
-async def handle_navigation(callback: types.CallbackQuery, state: FSMContext,
-                            data_key: str, show_func: Callable,
-                            prev_callback: str, next_callback: str):
-    if not callback.message:
-        return
-
-    data = await state.get_data()
-    current_page = data.get("current_page", 0)
-    results = data.get(data_key, [])
-    content_type = data.get("content_type", "movie")
-
-    if callback.data == prev_callback and current_page > 0:
-        current_page -= 1
-        await state.update_data(current_page=current_page)
-        await show_func(callback.message.chat.id, results[current_page], content_type, current_page, len(results))
-    elif callback.data == next_callback and current_page < len(results) - 1:
-        current_page += 1
-        await state.update_data(current_page=current_page)
-        await show_func(callback.message.chat.id, results[current_page], content_type, current_page, len(results))
-
-
-@dp.callback_query(F.data == "prev_page")
-async def prev_page(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "search_results", show_search_results, "prev_page", "next_page")
-
-
-@dp.callback_query(F.data == "next_page")
-async def next_page(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "search_results", show_search_results, "prev_page", "next_page")
-
-
-@dp.callback_query(F.data == "prev_popular")
-async def prev_popular(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "popular_results", show_popular_content, "prev_popular", "next_popular")
-
-
-@dp.callback_query(F.data == "next_popular")
-async def next_popular(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "popular_results", show_popular_content, "prev_popular", "next_popular")
-
-
-@dp.callback_query(F.data == "prev_similar")
-async def prev_similar(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "similar_results", show_similar_content, "prev_similar", "next_similar")
-
-
-@dp.callback_query(F.data == "next_similar")
-async def next_similar(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "similar_results", show_similar_content, "prev_similar", "next_similar")
-
-
-@dp.callback_query(F.data == "prev_favorite")
-async def prev_favorite(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "favorites", show_favorites_page, "prev_favorite", "next_favorite")
-
-
-@dp.callback_query(F.data == "next_favorite")
-async def next_favorite(callback: types.CallbackQuery, state: FSMContext):
-    await handle_navigation(callback, state, "favorites", show_favorites_page, "prev_favorite", "next_favorite")
-
-
 @dp.callback_query(F.data.startswith("remove_favorite_"))
 async def remove_from_favorites(callback: types.CallbackQuery, state: FSMContext):
     if not callback.message or not callback.data:
         return
 
-    try:
-        movie_id = int(callback.data.split("_")[-1])
-    except (ValueError, IndexError):
+    parsed = parse_favorite_callback(callback.data)
+    if parsed is None:
         return
+    media_type, movie_id = parsed
 
-    if remove_favorite(callback.from_user.id, movie_id):
+    if await remove_favorite(callback.from_user.id, media_type, movie_id):
         await callback.answer("Фильм удален из избранного!")
 
         data = await state.get_data()
-        favorites = data.get("favorites", [])
+        favorite_ids = [entry for entry in data.get("favorite_ids", []) if entry != [media_type, movie_id]]
         current_page = data.get("current_page", 0)
 
-        favorites = [f for f in favorites if f['id'] != movie_id]
-
-        if not favorites:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-            ])
+        if not favorite_ids:
             await send_message_with_cleanup(
                 callback.message.chat.id,
                 "У вас пока нет избранных фильмов.",
-                reply_markup=keyboard
+                reply_markup=BACK_KB
             )
             return
 
-        if current_page >= len(favorites):
-            current_page = len(favorites) - 1
+        if current_page >= len(favorite_ids):
+            current_page = len(favorite_ids) - 1
 
-        await state.update_data(favorites=favorites, current_page=current_page)
-        await show_favorites_page(callback.message.chat.id, favorites[current_page], current_page, len(favorites))
+        await state.update_data(favorite_ids=favorite_ids, current_page=current_page)
+        item = await resolve_item(callback.from_user.id, None, favorite_ids[current_page])
+        await show_favorites_page(callback.message.chat.id, item, "movie", current_page, len(favorite_ids))
     else:
         await callback.answer("Ошибка при удалении из избранного")
 
 
 @dp.message()
 async def handle_unknown_message(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Поиск фильма", callback_data="search")],
-        [InlineKeyboardButton(text="🎲 Случайный контент", callback_data="random")],
-        [InlineKeyboardButton(text="⭐ Избранное", callback_data="favorites")],
-        [InlineKeyboardButton(text="📺 Рекомендации", callback_data="recommendations")]
-    ])
-
     await send_message_with_cleanup(
         message.chat.id,
         "Для начала работы с ботом используйте команду /start\nИли выберите действие из меню ниже:",
-        reply_markup=keyboard
+        reply_markup=MAIN_MENU_KB
     )
 
 
 @dp.callback_query(F.data == "random_movie")
 async def show_random_movie(callback: types.CallbackQuery):
+    await callback.answer()
     if not callback.message:
         return
 
-    async with aiohttp.ClientSession():
-        page = random.randint(1, 500)
-        url = f"{TMDB_BASE_URL}/movie/popular?api_key={TMDB_API_KEY}&language=ru-RU&page={page}"
-        data = await make_api_request(url)
+    page = random.randint(1, 500)
+    url = f"{TMDB_BASE_URL}/movie/popular"
+    params = {"language": "ru-RU", "page": page}
+    data = await cached_get(http_session, url, params, ttl=LIST_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
-            ])
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                "Не удалось получить случайный фильм. Попробуйте еще раз.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            "Не удалось получить случайный фильм. Попробуйте еще раз.",
+            reply_markup=BACK_TO_RANDOM_KB
+        )
+        return
 
-        movie = random.choice(data["results"])
+    movie = random.choice(data["results"])
 
-        text = (
-            f"🎲 Случайный фильм:\n\n"
-            f"🎬 {movie.get('title', 'Нет названия')}\n"
-            f"📅 Год: {movie.get('release_date', 'Неизвестно')[:4]}\n"
-            f"⭐ Рейтинг: {movie.get('vote_average', 'Нет рейтинга')}/10\n"
-            f"📝 {movie.get('overview', 'Нет описания')}\n"
-        )
+    text = render_card(movie, "🎲 Случайный фильм:")
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_{movie.get('id')}")],
-            [InlineKeyboardButton(text="🎲 Другой фильм", callback_data="random_movie")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
-        ])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_movie_{movie.get('id')}")],
+        [InlineKeyboardButton(text="🎲 Другой фильм", callback_data="random_movie")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
+    ])
 
-        if movie.get("poster_path"):
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                text,
-                reply_markup=keyboard,
-                photo=f"{TMDB_IMAGE_BASE_URL}{movie['poster_path']}"
-            )
-        else:
-            await send_message_with_cleanup(callback.message.chat.id, text, reply_markup=keyboard)
+    if movie.get("poster_path"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            text,
+            reply_markup=keyboard,
+            photo=f"{TMDB_IMAGE_BASE_URL}{movie['poster_path']}"
+        )
+    else:
+        await send_message_with_cleanup(callback.message.chat.id, text, reply_markup=keyboard)
 
 
 @dp.callback_query(F.data == "random_tv")
 async def show_random_tv(callback: types.CallbackQuery):
+    await callback.answer()
     if not callback.message:
         return
 
-    async with aiohttp.ClientSession():
-        page = random.randint(1, 500)
-        url = f"{TMDB_BASE_URL}/tv/popular?api_key={TMDB_API_KEY}&language=ru-RU&page={page}"
-        data = await make_api_request(url)
+    page = random.randint(1, 500)
+    url = f"{TMDB_BASE_URL}/tv/popular"
+    params = {"language": "ru-RU", "page": page}
+    data = await cached_get(http_session, url, params, ttl=LIST_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
-            ])
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                "Не удалось получить случайный сериал. Попробуйте еще раз.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            "Не удалось получить случайный сериал. Попробуйте еще раз.",
+            reply_markup=BACK_TO_RANDOM_KB
+        )
+        return
 
-        tv_show = random.choice(data["results"])
+    tv_show = random.choice(data["results"])
 
-        text = (
-            f"🎲 Случайный сериал:\n\n"
-            f"📺 {tv_show.get('name', 'Нет названия')}\n"
-            f"📅 Год: {tv_show.get('first_air_date', 'Неизвестно')[:4]}\n"
-            f"⭐ Рейтинг: {tv_show.get('vote_average', 'Нет рейтинга')}/10\n"
-            f"📝 {tv_show.get('overview', 'Нет описания')}\n"
-        )
+    text = render_card(tv_show, "🎲 Случайный сериал:", icon="📺")
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_{tv_show.get('id')}")],
-            [InlineKeyboardButton(text="🎲 Другой сериал", callback_data="random_tv")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
-        ])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_tv_{tv_show.get('id')}")],
+        [InlineKeyboardButton(text="🎲 Другой сериал", callback_data="random_tv")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="random")]
+    ])
 
-        if tv_show.get("poster_path"):
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                text,
-                reply_markup=keyboard,
-                photo=f"{TMDB_IMAGE_BASE_URL}{tv_show['poster_path']}"
-            )
-        else:
-            await send_message_with_cleanup(callback.message.chat.id, text, reply_markup=keyboard)
+    if tv_show.get("poster_path"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            text,
+            reply_markup=keyboard,
+            photo=f"{TMDB_IMAGE_BASE_URL}{tv_show['poster_path']}"
+        )
+    else:
+        await send_message_with_cleanup(callback.message.chat.id, text, reply_markup=keyboard)
 
 
 @dp.callback_query(F.data.startswith("similar_"))
 async def show_similar_movies(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
     if not callback.message or not callback.data:
         return
 
@@ -616,50 +631,32 @@ async def show_similar_movies(callback: types.CallbackQuery, state: FSMContext):
     except (ValueError, IndexError):
         return
 
-    async with aiohttp.ClientSession():
-        url = f"{TMDB_BASE_URL}/movie/{movie_id}/similar?api_key={TMDB_API_KEY}&language=ru-RU&page=1"
-        data = await make_api_request(url)
+    url = f"{TMDB_BASE_URL}/movie/{movie_id}/similar"
+    params = {"language": "ru-RU", "page": 1}
+    data = await cached_get(http_session, url, params, ttl=DETAILS_CACHE_TTL)
 
-        if not data or not isinstance(data, dict) or not data.get("results"):
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-            ])
-            await send_message_with_cleanup(
-                callback.message.chat.id,
-                "Не удалось найти похожие фильмы. Попробуйте позже.",
-                reply_markup=keyboard
-            )
-            return
+    if not data or not isinstance(data, dict) or not data.get("results"):
+        await send_message_with_cleanup(
+            callback.message.chat.id,
+            "Не удалось найти похожие фильмы. Попробуйте позже.",
+            reply_markup=BACK_KB
+        )
+        return
 
-        results = data.get("results", [])[:10]
-        await state.update_data(similar_results=results, current_page=0, total_pages=len(results))
-        await show_similar_content(callback.message.chat.id, results[0], 0, len(results))
+    results = data.get("results", [])[:10]
+    await state.update_data(similar_ids=[["movie", item["id"]] for item in results],
+                            similar_source=list_source(url, params, DETAILS_CACHE_TTL),
+                            current_page=0, total_pages=len(results))
+    await show_similar_content(callback.message.chat.id, results[0], "movie", 0, len(results))
 
 
-async def show_similar_content(chat_id: int, item: dict, current_page: int, total_pages: int):
+async def show_similar_content(chat_id: int, item: dict, content_type: str, current_page: int, total_pages: int):
     if not isinstance(item, dict) or not item.get("id"):
         return
 
-    text = (
-        f"🎬 Похожие фильмы ({current_page + 1} из {total_pages}):\n\n"
-        f"🎬 {item.get('title', 'Нет названия')}\n"
-        f"📅 Год: {item.get('release_date', 'Неизвестно')[:4]}\n"
-        f"⭐ Рейтинг: {item.get('vote_average', 'Нет рейтинга')}/10\n"
-        f"📝 {item.get('overview', 'Нет описания')}\n"
-    )
+    text = render_card(item, f"🎬 Похожие фильмы ({current_page + 1} из {total_pages}):")
 
-    nav_buttons = []
-    if current_page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data="prev_similar"))
-    if current_page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="next_similar"))
-    nav_buttons.append(InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main"))
-
-    action_buttons = [
-        [InlineKeyboardButton(text="⭐ Добавить в избранное", callback_data=f"add_favorite_{item.get('id')}")]
-    ]
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=action_buttons + [nav_buttons])
+    keyboard = list_keyboard("similar", item.get("media_type", "movie"), item["id"], current_page > 0, current_page < total_pages - 1)
 
     if item.get("poster_path"):
         await send_message_with_cleanup(
@@ -672,35 +669,119 @@ async def show_similar_content(chat_id: int, item: dict, current_page: int, tota
         await send_message_with_cleanup(chat_id, text, reply_markup=keyboard)
 
 
+NAV_MAP = {
+    "page": ("search", show_search_results),
+    "popular": ("popular", show_popular_content),
+    "similar": ("similar", show_similar_content),
+    "favorite": ("favorite", show_favorites_page),
+}
+
+
+@dp.callback_query(F.data.regexp(r"^(prev|next)_(page|popular|similar|favorite)$"))
+async def handle_navigation(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    if not callback.message or not callback.data:
+        return
+
+    direction, kind = callback.data.split("_", 1)
+    list_name, show_func = NAV_MAP[kind]
+
+    data = await state.get_data()
+    current_page = data.get("current_page", 0)
+    ids = data.get(f"{list_name}_ids", [])
+    content_type = data.get("content_type", "movie")
+
+    if direction == "prev" and current_page > 0:
+        current_page -= 1
+    elif direction == "next" and current_page < len(ids) - 1:
+        current_page += 1
+    else:
+        return
+
+    await state.update_data(current_page=current_page)
+    item = await resolve_item(callback.from_user.id, data.get(f"{list_name}_source"), ids[current_page])
+    await show_func(callback.message.chat.id, item, content_type, current_page, len(ids))
+
+
 @dp.callback_query(F.data.startswith("add_favorite_"))
-async def add_to_favorites(callback: types.CallbackQuery):
+async def add_to_favorites(callback: types.CallbackQuery, state: FSMContext):
     if not callback.message or not callback.data:
         return
 
-    try:
-        movie_id = int(callback.data.split("_")[-1])
-    except (ValueError, IndexError):
+    parsed = parse_favorite_callback(callback.data)
+    if parsed is None:
         return
+    media_type, movie_id = parsed
 
-    async with aiohttp.ClientSession():
-        url = f"{TMDB_BASE_URL}/movie/{movie_id}?api_key={TMDB_API_KEY}&language=ru-RU"
-        data = await make_api_request(url)
+    if await is_favorite(callback.from_user.id, media_type, movie_id):
+        await callback.answer("❌ Фильм уже в избранном")
+        return
 
-        if not data or not isinstance(data, dict):
-            await callback.answer("❌ Ошибка при добавлении в избранное")
-            return
+    data = await find_shown_item(callback.from_user.id, await state.get_data(), media_type, movie_id)
+    if data is None:
+        url = f"{TMDB_BASE_URL}/{media_type}/{movie_id}"
+        params = {"language": "ru-RU"}
+        data = await cached_get(http_session, url, params, ttl=DETAILS_CACHE_TTL)
 
-        title = data.get("title", "Неизвестный фильм")
-        poster_path = data.get("poster_path", "")
+    if not data or not isinstance(data, dict):
+        await callback.answer("❌ Ошибка при добавлении в избранное")
+        return
 
-        if add_favorite(callback.from_user.id, movie_id, title, poster_path):
-            await callback.answer("✅ Фильм добавлен в избранное!")
-        else:
-            await callback.answer("❌ Фильм уже в избранном")
+    title = data.get("title") or data.get("name") or "Неизвестный фильм"
+    poster_path = data.get("poster_path", "")
+
+    if await add_favorite(callback.from_user.id, media_type, movie_id, title, poster_path):
+        await callback.answer("✅ Фильм добавлен в избранное!")
+    else:
+        await callback.answer("❌ Фильм уже в избранном")
+
+
+async def run_db_maintenance():
+    while True:
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+        await asyncio.to_thread(maintenance)
+
+
+async def refresh_popular_lists():
+    while True:
+        for url in (POPULAR_MOVIES_URL, POPULAR_TV_URL):
+            try:
+                await cached_get(http_session, url, POPULAR_PARAMS, ttl=0)
+            except Exception as e:
+                logging.warning(f"Failed to refresh {url}: {e}")
+        await asyncio.sleep(POPULAR_REFRESH_INTERVAL)
+
+
+async def on_startup():
+    global http_session, popular_refresh_task
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            ssl=SSL_CONTEXT
+        ),
+        timeout=API_TIMEOUT
+    )
+    popular_refresh_task = asyncio.create_task(refresh_popular_lists())
+
+
+async def on_shutdown():
+    if popular_refresh_task is not None:
+        popular_refresh_task.cancel()
+    if http_session is not None:
+        await http_session.close()
 
 
 async def main():
-    await dp.start_polling(bot)
+    await asyncio.to_thread(init_db)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    maintenance_task = asyncio.create_task(run_db_maintenance())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        maintenance_task.cancel()
 
 
 if __name__ == "__main__":